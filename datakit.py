@@ -9,9 +9,14 @@ License: MIT (see LICENSE.md for details)
 
 import logging
 import re
+from bisect import bisect_left
+from threading import Lock
 
 log = logging.getLogger()
 
+# log-spaced bucket bounds (in seconds) from 10us to ~2min, about 19% apart
+_latency_bounds = [1e-5 * 2 ** (i / 4.0) for i in range(96)]
+
 _stopwords = {"en":"i,a,an,are,as,at,be,by,for,from,how,in,is,it,of,on,or,that,the,this,to,was,what,when,where".split(',')}
 
 
@@ -89,3 +94,62 @@ def damerau_levenshtein_distance(a, b, limit=None):
             return limit + 1
 
     return thisrow[len(b) - 1]
+
+
+class Histogram(object):
+    """Log-bucketed histogram for latencies, cheap enough to update on every call"""
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds or _latency_bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.mutex = Lock()
+
+    def add(self, value):
+        i = bisect_left(self.bounds, value)
+        with self.mutex:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p-th percentile"""
+
+        with self.mutex:
+            counts, count, top = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        rank = p / 100.0 * count
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank and c:
+                return min(self.bounds[i], top) if i < len(self.bounds) else top
+        return top
+
+    def buckets(self):
+        """Return (upper bound, cumulative count) pairs for non-empty buckets, ending with infinity"""
+
+        with self.mutex:
+            counts = list(self.counts)
+        result, seen = [], 0
+        for bound, c in zip(self.bounds, counts):
+            seen += c
+            if c:
+                result.append((bound, seen))
+        result.append((float('inf'), seen + counts[-1]))
+        return result
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'sum'  : self.sum,
+            'max'  : self.max,
+            'p50'  : self.percentile(50),
+            'p95'  : self.percentile(95),
+            'p99'  : self.percentile(99)
+        }
@@ -10,6 +10,7 @@ License: MIT (see LICENSE.md for details)
 import logging
 import inspect
 from bottle import app
+from decorators import timing_stats
 
 log = logging.getLogger()
 
@@ -18,6 +19,7 @@ def docs():
 
     routes = []
     modules = {}
+    timings = timing_stats()
     for route in app().routes:
         doc = inspect.getdoc(route.callback) or inspect.getcomments(route.callback)
         if not doc:
@@ -28,7 +30,8 @@ def docs():
             'route': route.rule,
             'function': route.callback.__name__,
             'module': module,
-            'doc': inspect.cleandoc(doc)
+            'doc': inspect.cleandoc(doc),
+            'latency': timings.get('%s %s' % (route.method, route.rule))
         }
         if not module in modules:
             modules[module] = []
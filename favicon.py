@@ -42,7 +42,8 @@ def html_fetcher(site):
     """Fetch the favicon the hard way"""
     endpoint = "http://%s" % urlparse.urlparse(site).hostname
     try:
-        res = fetch(endpoint)
+        # icon links live in the <head>, so there's no need to download the rest of the page
+        res = fetch(endpoint, until='</head>', max_bytes=256*1024)
     except Exception, e:
         log.error("Could not fetch %s: %s" % (endpoint, e))
         return None
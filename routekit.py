@@ -11,6 +11,7 @@ import os
 import sys
 import logging
 import json
+from decorators import timing_stats
 
 log = logging.getLogger()
 
@@ -29,3 +30,20 @@ def dump_routes(app):
     for prefixes, route in inspect_routes(app):
         abs_prefix = '/'.join(part for p in prefixes for part in p.split('/'))
         log.warn("Prefix:'%s' Route:'%s' [%s] %s" % (abs_prefix, route.rule, route.method, route.callback))
+
+def route_latencies(app):
+    """Pair each route with the latency stats recorded for it by decorators.timed"""
+
+    timings = timing_stats()
+    result = []
+    for prefixes, route in inspect_routes(app):
+        path = ''.join(p.rstrip('/') for p in prefixes) + route.rule
+        stats = timings.get('%s %s' % (route.method, path))
+        if stats:
+            result.append({
+                'method': route.method,
+                'route': path,
+                'function': route.callback.__name__,
+                'latency': stats
+            })
+    return result
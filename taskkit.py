@@ -8,80 +8,621 @@ License: MIT (see LICENSE.md for details)
 """
 
 from Queue import Empty, Queue, PriorityQueue
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from heapq import heappush, heappop, heapify
 from functools import partial
 from signal import signal, SIGINT, SIGTERM, SIGHUP
 import sys, logging 
-from threading import Semaphore, Thread
-import time, traceback, ctypes
+from threading import Condition, Event, Lock, Semaphore, Thread, currentThread
+import os, time, traceback, ctypes, struct, zlib
 from uuid import uuid4
 from cPickle import dumps, loads
 import multiprocessing
+from weakref import WeakValueDictionary, ref
+from datakit import Histogram
+from pipekit import chunk
+
+# Allow importing even when no asyncio implementation is present
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+if asyncio:
+    _ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
 
 log = logging.getLogger(__name__)
 
 default_priority = 0
+default_rate_limit = 1000
 max_workers = multiprocessing.cpu_count() * 2
-channels = {}
-closed = {}
+_stop_priority = float('-inf')
+backends = ['thread', 'process']
+channels = {} # uuid -> state, for channels that are open or still hold items
+closed_channels = WeakValueDictionary() # drained closed channels, kept while shims refer to them
+batches = {}
+
+class ResultStore(object):
+    """Bounded storage for task results, evicting the oldest or expired ones that were never collected"""
+
+    def __init__(self, max_size = None, ttl = None, serialize = True):
+        self.max_size  = max_size
+        self.ttl       = ttl
+        self.serialize = serialize
+        self.mutex     = Lock()
+        self.items     = OrderedDict() # uuid -> (stored, size, result, retries)
+        self.bytes     = 0
+        self.evicted   = 0
+        self.expired   = 0
+        self.collected = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, uuid):
+        return uuid in self.items
+
+    def _remove(self, uuid):
+        stored, size, result, retries = self.items.pop(uuid)
+        self.bytes -= size
+        return result, retries
+
+    def _expire(self, now):
+        # items are kept in insertion order, so the oldest are always up front
+        if self.ttl is not None:
+            while self.items:
+                uuid, item = next(self.items.iteritems())
+                if now - item[0] < self.ttl:
+                    break
+                self._remove(uuid)
+                self.expired += 1
+        if self.max_size is not None:
+            while len(self.items) > self.max_size:
+                self._remove(next(self.items.iterkeys()))
+                self.evicted += 1
+
+    def put(self, uuid, result, retries):
+        """Store a task result"""
+        if self.serialize:
+            result = dumps(result)
+            size = len(result)
+        else:
+            # shallow estimate, since the object is stored as-is
+            size = sys.getsizeof(result)
+        now = time.time()
+        with self.mutex:
+            if uuid in self.items:
+                self._remove(uuid)
+            self.items[uuid] = (now, size, result, retries)
+            self.bytes += size
+            self._expire(now)
+
+    def collect(self, uuid):
+        """Remove and return (result, retries) for a task, raising KeyError if unknown or evicted"""
+        with self.mutex:
+            result, retries = self._remove(uuid)
+            self.collected += 1
+        if self.serialize:
+            result = loads(result)
+        return result, retries
+
+    def discard(self, uuid):
+        """Drop a result nobody can collect any more"""
+        with self.mutex:
+            if uuid in self.items:
+                self._remove(uuid)
+
+    def clear(self):
+        with self.mutex:
+            self.items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.mutex:
+            self._expire(time.time())
+            return {
+                'items'    : len(self.items),
+                'bytes'    : self.bytes,
+                'evicted'  : self.evicted,
+                'expired'  : self.expired,
+                'collected': self.collected
+            }
+
+
+class TaskStats(object):
+    """Counters and latency histograms for one task name"""
+
+    def __init__(self):
+        self.mutex     = Lock()
+        self.completed = 0
+        self.failed    = 0
+        self.retried   = 0
+        self.wait      = Histogram() # from submission to start
+        self.run       = Histogram()
+
+    def record(self, queued, started, finished, outcome):
+        if queued is not None:
+            self.wait.add(started - queued)
+        self.run.add(finished - started)
+        with self.mutex:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        return {
+            'completed': self.completed,
+            'failed'   : self.failed,
+            'retried'  : self.retried,
+            'wait'     : self.wait.stats(),
+            'run'      : self.run.stats()
+        }
+
+
+class Metrics(object):
+    """Per-task execution metrics, exportable as a dict or Prometheus text"""
+
+    def __init__(self):
+        self.mutex = Lock()
+        self.tasks = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.tasks[name]
+        except KeyError:
+            with self.mutex:
+                return self.tasks.setdefault(name, TaskStats())
+
+    def stats(self):
+        return {name: stats.stats() for name, stats in self.tasks.items()}
+
+    def prometheus(self, prefix = 'taskkit'):
+        lines = []
+        tasks = sorted(self.tasks.items())
+        for counter in ['completed', 'failed', 'retried']:
+            lines.append('# TYPE %s_tasks_%s_total counter' % (prefix, counter))
+            for name, stats in tasks:
+                lines.append('%s_tasks_%s_total{task="%s"} %d' % (prefix, counter, name, getattr(stats, counter)))
+        for histogram in ['wait', 'run']:
+            metric = '%s_task_%s_seconds' % (prefix, histogram)
+            lines.append('# TYPE %s histogram' % metric)
+            for name, stats in tasks:
+                h = getattr(stats, histogram)
+                for bound, count in h.buckets():
+                    le = '+Inf' if bound == float('inf') else '%g' % bound
+                    lines.append('%s_bucket{task="%s",le="%s"} %d' % (metric, name, le, count))
+                lines.append('%s_sum{task="%s"} %f' % (metric, name, h.sum))
+                lines.append('%s_count{task="%s"} %d' % (metric, name, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+class TokenBucket(object):
+    """Allows `rate` operations per second, in bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity = None):
+        self.rate     = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens   = self.capacity
+        self.stamp    = time.time()
+        self.mutex    = Lock()
+
+    def take(self):
+        """Take a token, returning 0 on success or the number of seconds until one is available"""
+        with self.mutex:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class Limit(object):
+    """Rate and concurrency caps for a group of tasks"""
+
+    def __init__(self, rate = None, concurrency = None):
+        self.bucket      = TokenBucket(rate) if rate else None
+        self.concurrency = concurrency
+        self.running     = 0
+        self.parked      = deque()
+        self.mutex       = Lock()
+
+    def acquire(self, item):
+        """Returns 0 if the task may run now, the delay before retrying, or None if it was parked"""
+        with self.mutex:
+            if self.concurrency and self.running >= self.concurrency:
+                self.parked.append(item)
+                return None
+            wait = self.bucket.take() if self.bucket else 0
+            if not wait:
+                self.running += 1
+            return wait
+
+    def release(self):
+        """Free a slot, returning a parked task to resubmit (if any)"""
+        with self.mutex:
+            self.running -= 1
+            if self.parked:
+                return self.parked.popleft()
+
+
+class DurableQueue(PriorityQueue):
+    """A priority queue that journals pending tasks to an append-only log and replays them on startup"""
+
+    header = struct.Struct('>II') # record length, crc32
+
+    def __init__(self, path, commit_interval = 0.01, synchronous = False, compact_threshold = 100000):
+        PriorityQueue.__init__(self)
+        self.path              = path
+        self.commit_interval   = commit_interval
+        self.synchronous       = synchronous
+        self.compact_threshold = compact_threshold
+        self.journal           = Condition(Lock())
+        self.buffer            = []
+        self.pending           = {} # seq -> (priority, data), queued or in flight
+        self.inflight          = defaultdict(deque) # data -> seqs of dequeued copies, oldest first
+        self.appended          = 0
+        self.committed         = 0
+        self.garbage           = 0
+        self.closed            = False
+        self._replay()
+        self.writer = Thread(target=self._writer)
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def _record(self, record):
+        payload = dumps(record, 2)
+        return self.header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def _replay(self):
+        """Load unacknowledged tasks from the log and rewrite it with only those"""
+        pending = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                while True:
+                    header = journal.read(self.header.size)
+                    if len(header) < self.header.size:
+                        break
+                    length, crc = self.header.unpack(header)
+                    payload = journal.read(length)
+                    # stop at a torn or corrupted tail
+                    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                        log.warn("Ignoring damaged tail of %s" % self.path)
+                        break
+                    record = loads(payload)
+                    if record[0] == 'p':
+                        pending[record[1]] = (record[2], record[3])
+                    else:
+                        pending.pop(record[1], None)
+        self.seq = max(pending) + 1 if pending else 0
+        for seq, (priority, data) in pending.iteritems():
+            heappush(self.queue, (priority, seq, data))
+        self.unfinished_tasks += len(pending)
+        self.pending = pending
+        self._rewrite()
+        if pending:
+            log.info("Replayed %d pending tasks from %s" % (len(pending), self.path))
+
+    def _rewrite(self):
+        """Atomically replace the log with put records for pending tasks (called with the journal held)"""
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as out:
+            out.write(''.join(self._record(('p', seq, priority, data)) for seq, (priority, data) in self.pending.iteritems()))
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(temp, self.path)
+        self.file = open(self.path, 'ab')
+        self.garbage = 0
+
+    def _writer(self):
+        """Group commit: write and fsync whatever accumulated since the last commit"""
+        while True:
+            with self.journal:
+                while not self.buffer and not self.closed:
+                    self.journal.wait()
+                if not self.buffer:
+                    return
+                batch, self.buffer = self.buffer, []
+                target = self.appended
+            self.file.write(''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with self.journal:
+                self.committed = target
+                self.journal.notify_all()
+                if self.garbage > self.compact_threshold and self.garbage > len(self.pending):
+                    self.file.close()
+                    self._rewrite()
+            if self.commit_interval and not self.synchronous:
+                # let the next group build up (synchronous puts form groups while waiting on fsync)
+                time.sleep(self.commit_interval)
+
+    def _append(self, record):
+        # called with the journal held
+        self.buffer.append(self._record(record))
+        self.appended += 1
+        self.journal.notify_all()
+
+    def _put(self, item):
+        priority, data = item
+        if data is None:
+            # stop markers are never journaled
+            heappush(self.queue, item)
+            return
+        with self.journal:
+            seq = self.seq
+            self.seq += 1
+            self.pending[seq] = item
+            self._append(('p', seq, priority, data))
+        heappush(self.queue, (priority, seq, data))
+
+    def _get(self):
+        entry = heappop(self.queue)
+        if len(entry) == 2:
+            return entry
+        priority, seq, data = entry
+        with self.journal:
+            # identical payloads can be in flight at once (e.g., a parked task and its resubmitted copy)
+            self.inflight[data].append(seq)
+        return priority, data
+
+    def put(self, item, block = True, timeout = None):
+        PriorityQueue.put(self, item, block, timeout)
+        if self.synchronous:
+            self.sync()
+
+    def ack(self, data):
+        """Mark a dequeued task as handled, so that it won't be replayed"""
+        with self.journal:
+            seqs = self.inflight.get(data)
+            if not seqs:
+                return
+            # the oldest copy is the one being acknowledged, since resubmissions ack after queueing their replacement
+            seq = seqs.popleft()
+            if not seqs:
+                del self.inflight[data]
+            del self.pending[seq]
+            self._append(('a', seq))
+            self.garbage += 2
+
+    def sync(self):
+        """Block until everything journaled so far is on disk"""
+        with self.journal:
+            target = self.appended
+            while self.committed < target and self.writer.isAlive():
+                self.journal.wait()
+
+    def close(self):
+        with self.journal:
+            self.closed = True
+            self.journal.notify_all()
+        self.writer.join()
+        self.file.close()
+
 
 class Pool:
-    """Represents a thread pool"""
+    """Represents a thread pool, optionally backed by worker processes for CPU-bound tasks"""
 
-    def __init__(self, workers = max_workers, rate_limit = 1000):
+    def __init__(self, workers = max_workers, rate_limit = default_rate_limit, persistent = False, backend = 'thread', results = None, queue = None):
+        if backend not in backends:
+            raise ValueError("Unknown backend '%s'" % backend)
         self.max_workers = workers
         self.mutex       = Semaphore()
-        self.results     = {}
+        # finished results, while retries only tracks tasks still in flight
+        self.results     = results if results is not None else ResultStore()
         self.retries     = defaultdict(int)
-        self.queue       = PriorityQueue()
+        self.queue       = queue if queue is not None else PriorityQueue()
+        self.durable     = isinstance(self.queue, DurableQueue)
+        self.deferreds   = WeakValueDictionary()
+        self.enqueued    = {} # uuid -> submission time
+        self.metrics     = Metrics()
+        self.loop        = None
+        self.coroutines  = set() # futures of coroutine tasks on the event loop
         self.threads     = []
         self.rate_limit  = rate_limit
+        self.interval    = 1.0/(rate_limit or default_rate_limit)
         self.running     = True
+        self.backend     = backend
+        self.processes   = None
+        # process pools are fed by persistent dispatcher threads
+        self.persistent  = persistent or backend == 'process'
+        # task name (or None for the whole pool) -> Limit, enforced by persistent workers
+        self.limits      = {}
+        self.delayed     = [] # heap of (ready time, priority, data)
+        self.signalled   = False # whether the current workers have been sent stop markers
+        self.timer       = Condition(Lock())
+        if self.persistent and rate_limit:
+            self.limits[None] = Limit(rate_limit)
+
+
+    def limit(self, name = None, rate = None, concurrency = None):
+        """Cap tasks called `name` (or the whole pool) to `rate` per second and `concurrency` at once.
+           Limits are enforced by persistent workers, so the pool must be persistent (or a process pool)"""
+        if not self.persistent:
+            raise RuntimeError("Limits need a persistent pool, e.g. Pool(persistent=True).")
+        self.limits[name] = Limit(rate, concurrency)
+
 
     def _tick(self):
-        time.sleep(1.0/self.rate_limit)
+        time.sleep(self.interval)
         # clean up finished threads
         self.threads = [t for t in self.threads if t.isAlive()]
         return (not self.queue.empty()) or (len(self.threads) > 0)
 
 
-    def _loop(self):
-        """Handle task submissions"""
+    def submit(self, priority, f, uuid, retries, args, kwargs):
+        """Queue a task for the worker threads"""
 
-        def run_task(priority, f, uuid, retries, args, kwargs):
-            """Run a single task"""
-            try:
-                t.name = getattr(f, '__name__', None)
+        if uuid is not None:
+            self.enqueued[uuid] = time.time()
+        self.queue.put((priority, dumps((f, uuid, retries, args, kwargs))))
+
+
+    def _run(self, priority, data, f, uuid, retries, args, kwargs):
+        """Run a single task"""
+
+        name = getattr(f, '__name__', None)
+        queued = self.enqueued.pop(uuid, None)
+        started = time.time()
+        try:
+            currentThread().name = name
+            # batch runners stay in this process and hand chunks over themselves
+            if self.processes and f is not _run_batch:
+                result = self.processes.apply(f, args, kwargs)
+            else:
                 result = f(*args, **kwargs)
+        except Exception as e:
+            # Retry the task if applicable
+            if log:
+                log.error(traceback.format_exc())
+            if retries > 0:
+                self.metrics[name].record(queued, started, time.time(), 'retried')
+                with self.mutex:
+                    self.retries[uuid] += 1
+                # re-queue the task with a lower (i.e., higher-valued) priority
+                self.submit(priority+1, f, uuid, retries - 1, args, kwargs)
+                self._task_done(data)
+                return
+            self.metrics[name].record(queued, started, time.time(), 'failed')
+            result = e
+        else:
+            self.metrics[name].record(queued, started, time.time(), 'completed')
+        try:
+            self._finish(uuid, result)
+        except Exception as e:
+            # e.g., a result the store can't pickle, which would otherwise leave the Deferred unset
+            log.error(traceback.format_exc())
+            self._finish(uuid, e)
+        finally:
+            self._task_done(data)
+
+
+    def _task_done(self, data):
+        """Mark a dequeued task as handled, acknowledging it to durable queues"""
+
+        if self.durable:
+            self.queue.ack(data)
+        self.queue.task_done()
+
+
+    def _finish(self, uuid, result):
+        """Store a task result and notify whoever is waiting on it"""
+
+        if uuid is None:
+            # fire-and-forget, like batch runners
+            return
+        with self.mutex:
+            retries = self.retries.get(uuid, 0) + 1
+            if uuid not in self.deferreds:
+                # nobody holds the Deferred any more, so the result could never be collected
+                self.retries.pop(uuid, None)
+                return
+        # store first, so that a failure here leaves the Deferred around to be notified of it
+        self.results.put(uuid, result, retries)
+        with self.mutex:
+            self.retries.pop(uuid, None)
+            deferred = self.deferreds.pop(uuid, None)
+        if deferred is not None:
+            deferred._set()
+        else:
+            # the Deferred went away while the task was finishing
+            self.results.discard(uuid)
+
+
+    def _event_loop(self):
+        """Lazily start an event loop thread for coroutine tasks"""
+
+        with self.mutex:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                t = Thread(target=self._run_loop, args=[self.loop])
+                t.setDaemon(True)
+                t.start()
+        return self.loop
+
+
+    def _run_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+
+    def schedule(self, f, uuid, retries, args, kwargs):
+        """Run a coroutine function on the pool's event loop instead of a worker thread
+
+        Coroutines start right away, whether or not the pool has been started, and limit() doesn't apply
+        to them. They do count as unfinished tasks, so a blocking start() waits for them, and stop() or
+        kill_all() cancel them."""
+
+        queue = self.queue
+        with queue.mutex:
+            queue.unfinished_tasks += 1
+        self.enqueued[uuid] = time.time()
+        self._event_loop().call_soon_threadsafe(self._start_coroutine, queue, f, uuid, retries, args, kwargs)
+
+
+    def _start_coroutine(self, queue, f, uuid, retries, args, kwargs):
+        queued = self.enqueued.pop(uuid, None)
+        try:
+            future = _ensure_future(f(*args, **kwargs), loop=self.loop)
+        except Exception as e:
+            # e.g., bad arguments: report it like a coroutine that failed straight away
+            future = asyncio.Future(loop=self.loop)
+            future.set_exception(e)
+        self.coroutines.add(future)
+        future.add_done_callback(partial(self._coroutine_done, queue, f, uuid, retries, args, kwargs, queued, time.time()))
+
+
+    def _coroutine_done(self, queue, f, uuid, retries, args, kwargs, queued, started, future):
+        self.coroutines.discard(future)
+        stats = self.metrics[getattr(f, '__name__', None)]
+        if future.cancelled():
+            stats.record(queued, started, time.time(), 'failed')
+            result = asyncio.CancelledError()
+        else:
+            try:
+                result = future.result()
             except Exception as e:
-                # Retry the task if applicable
                 if log:
                     log.error(traceback.format_exc())
-                if retries > 0:
+                if retries > 0 and self.running:
+                    stats.record(queued, started, time.time(), 'retried')
                     with self.mutex:
                         self.retries[uuid] += 1
-                    # re-queue the task with a lower (i.e., higher-valued) priority
-                    self.queue.put((priority+1, dumps((f, uuid, retries - 1, args, kwargs))))
-                    self.queue.task_done()
+                    self.enqueued[uuid] = time.time()
+                    self._start_coroutine(queue, f, uuid, retries - 1, args, kwargs)
                     return
+                stats.record(queued, started, time.time(), 'failed')
                 result = e
-            with self.mutex:
-                self.results[uuid] = dumps(result)
-                self.retries[uuid] += 1
-            self.queue.task_done()
+            else:
+                stats.record(queued, started, time.time(), 'completed')
+        try:
+            self._finish(uuid, result)
+        finally:
+            queue.task_done()
+
+
+    def _cancel_coroutines(self):
+        if self.loop:
+            for future in list(self.coroutines):
+                self.loop.call_soon_threadsafe(future.cancel)
+
+
+    def _loop(self):
+        """Handle task submissions"""
 
         while self._tick():
             # spawn more threads to fill free slots
-            log.debug("Running %d/%d threads" % (len(self.threads),self.max_workers))
             if self.running and len(self.threads) < self.max_workers:
-                log.debug("Queue Length: %d" % self.queue.qsize())
                 try:
-                    priority, data = self.queue.get(True, 1.0/self.rate_limit)
+                    priority, data = self.queue.get(True, self.interval)
                 except Empty:
                     continue
-                f, uuid, retries, args, kwargs = loads(data)
-                log.debug(f)
-                t = Thread(target=run_task, args=[priority, f, uuid, retries, args, kwargs])
+                task = self._load(data)
+                if task is None:
+                    continue
+                t = Thread(target=self._run, args=[priority, data] + list(task))
                 t.setDaemon(True)
                 self.threads.append(t)
                 t.start()
@@ -90,26 +631,223 @@ class Pool:
             t.join()
 
 
+    def _load(self, data):
+        """Unpickle a queued task, dropping it (but marking it done) if that fails"""
+
+        try:
+            return loads(data)
+        except Exception:
+            # e.g., a task replayed from a durable queue whose function no longer exists
+            log.error(traceback.format_exc())
+            self._task_done(data)
+            return None
+
+
+    def _worker(self):
+        """Long-lived worker that blocks on the queue until it gets a stop marker"""
+
+        while True:
+            priority, data = self.queue.get()
+            if data is None:
+                self.queue.task_done()
+                return
+            task = self._load(data)
+            if task is None:
+                continue
+            name = getattr(task[0], '__name__', None)
+            # tasks that can't run yet stay unfinished until they are resubmitted
+            if not self._admit(None, priority, data):
+                continue
+            if not self._admit(name, priority, data):
+                self._release(None)
+                continue
+            try:
+                self._run(priority, data, *task)
+            finally:
+                self._release(name)
+                self._release(None)
+
+
+    def _admit(self, name, priority, data):
+        """Check a task against its limits, parking or delaying it if it can't run now"""
+
+        limit = self.limits.get(name)
+        if limit is None:
+            return True
+        wait = limit.acquire((priority, data))
+        if wait:
+            with self.timer:
+                heappush(self.delayed, (time.time() + wait, priority, data))
+                self.timer.notify()
+        return wait == 0
+
+
+    def _release(self, name):
+        limit = self.limits.get(name)
+        if limit is None:
+            return
+        item = limit.release()
+        if item:
+            self._resubmit(item)
+
+
+    def _resubmit(self, item):
+        # the original queue entry is only marked done once its replacement is queued
+        self.queue.put(item)
+        self._task_done(item[1])
+
+
+    def _timer(self):
+        """Resubmit delayed tasks once they are due, blocking while there is nothing to do"""
+
+        with self.timer:
+            while self.running:
+                if not self.delayed:
+                    self.timer.wait()
+                    continue
+                wait = self.delayed[0][0] - time.time()
+                if wait > 0:
+                    self.timer.wait(wait)
+                    continue
+                ready, priority, data = heappop(self.delayed)
+                self._resubmit((priority, data))
+
+
+    def _spawn(self):
+        """Start the persistent worker threads"""
+
+        self.threads = [t for t in self.threads if t.isAlive()]
+        # drop markers meant for workers that are gone, or the new ones would exit straight away
+        queue = self.queue
+        with queue.mutex:
+            markers = [entry for entry in queue.queue if entry[-1] is None]
+            if markers:
+                queue.queue = [entry for entry in queue.queue if entry[-1] is not None]
+                heapify(queue.queue)
+                queue.unfinished_tasks -= len(markers)
+                if not queue.unfinished_tasks:
+                    queue.all_tasks_done.notify_all()
+        self.signalled = False
+        if self.backend == 'process' and not self.processes:
+            self.processes = multiprocessing.Pool(self.max_workers)
+        for i in xrange(self.max_workers):
+            t = Thread(target=self._worker)
+            t.setDaemon(True)
+            self.threads.append(t)
+            t.start()
+        t = Thread(target=self._timer)
+        t.setDaemon(True)
+        t.start()
+
+
+    def _drain(self):
+        """Wait for all queued tasks (including retries) to finish, then stop the workers"""
+
+        queue = self.queue
+        with queue.all_tasks_done:
+            while self.running and queue.unfinished_tasks:
+                # timed wait so that signal handlers still get a chance to run
+                queue.all_tasks_done.wait(0.5)
+        self.stop()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        if self.processes:
+            self.processes.close()
+            self.processes.join()
+            self.processes = None
+        log.debug("Exited loop.")
+
+
+    def stats(self):
+        """Return a snapshot of pool state and per-task metrics"""
+
+        return {
+            'queue'  : self.queue.qsize(),
+            'workers': len(self.threads),
+            'results': self.results.stats(),
+            'tasks'  : self.metrics.stats()
+        }
+
+
+    def prometheus(self, prefix = 'taskkit'):
+        """Return pool state and per-task metrics in Prometheus text format"""
+
+        return '\n'.join([
+            '# TYPE %s_queue_length gauge' % prefix,
+            '%s_queue_length %d' % (prefix, self.queue.qsize()),
+            '# TYPE %s_workers gauge' % prefix,
+            '%s_workers %d' % (prefix, len(self.threads)),
+            self.metrics.prometheus(prefix)])
+
+
     def kill_all(self):
         """Very hacky way to kill threads by tossing an exception into their state"""
         for t in self.threads:
             ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(t.ident), ctypes.py_object(SystemExit))
+        if self.processes:
+            self.processes.terminate()
+            self.processes = None
+        if self.loop:
+            self._cancel_coroutines()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
 
 
     def stop(self):
         """Flush the job queue"""
         self.running = False
-        self.queue = PriorityQueue()
+        self.enqueued.clear()
+        self._cancel_coroutines()
+        if not self.persistent and not self.durable:
+            self.queue = PriorityQueue()
+            return
+        # workers may be blocked on this queue, so flush it in place
+        # (without acknowledging anything, so durable queues replay it)
+        try:
+            while True:
+                self.queue.get_nowait()
+                self.queue.task_done()
+        except Empty:
+            pass
+        with self.timer:
+            for item in self.delayed:
+                self.queue.task_done()
+            self.delayed = []
+            self.timer.notify()
+        for limit in self.limits.values():
+            with limit.mutex:
+                for item in limit.parked:
+                    self.queue.task_done()
+                limit.parked.clear()
+        if self.durable:
+            self.queue.sync()
+        if not self.persistent:
+            return
+        # stop markers sort ahead of any real task, and are only sent once per set of workers
+        # (stop() may run again, e.g., from a signal handler while start() is draining)
+        if self.signalled:
+            return
+        self.signalled = True
+        for t in self.threads:
+            self.queue.put((_stop_priority, None))
 
 
     def start(self, daemonize=False):
         """Pool entry point"""
 
-        self.results = {}
+        self.results.clear()
         self.retries = defaultdict(int)
+        self.running = True
+
+        if self.persistent:
+            self._spawn()
+            if not daemonize:
+                self._drain()
+            return
 
         if daemonize:
-            t = Thread(target = self._loop, args=[self])
+            t = Thread(target = self._loop)
             t.setDaemon(True)
             t.start()
             return
@@ -122,21 +860,86 @@ default_pool = Pool()
 class Deferred(object):
     """Allows lookup of task results and status"""
     def __init__(self, pool, uuid):
-        self.uuid    = uuid
-        self.pool    = pool
-        self._result = None
+        self.uuid       = uuid
+        self.pool       = pool
+        self._result    = None
+        self._retries   = 0
+        self._collected = False
+        self._done      = Event()
+        self._lock      = Lock()
+        self._callbacks = []
+        with pool.mutex:
+            pool.deferreds[uuid] = self
+
+    def _set(self):
+        """Called by the pool once the result is stored"""
+        # drop the stored result if this Deferred is thrown away without collecting it
+        results, uuid = self.pool.results, self.uuid
+        self._finalizer = ref(self, lambda r: results.discard(uuid))
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._invoke(callback)
+
+    def _invoke(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.error(traceback.format_exc())
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """Block until the task finishes, returning False if the timeout expired first"""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Call callback(deferred) once the task finishes (immediately if it already has)"""
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        self._invoke(callback)
+
+    def _collect(self):
+        """Take the result out of the pool's store once the task is done"""
+        if self._collected or not self._done.isSet():
+            return
+        try:
+            self._result, self._retries = self.pool.results.collect(self.uuid)
+        except KeyError:
+            log.warn("Result for task %s was evicted before collection" % self.uuid)
+        self._collected = True
 
     @property
     def result(self):
-        if self._result is None:
-            with self.pool.mutex:
-                if self.uuid in self.pool.results.keys():
-                   self._result = loads(self.pool.results[self.uuid])
+        self._collect()
         return self._result
 
     @property
     def retries(self):
-        return self.pool.retries[self.uuid]
+        self._collect()
+        if self._collected:
+            return self._retries
+        with self.pool.mutex:
+            return self.pool.retries.get(self.uuid, 0)
+
+    def future(self, loop=None):
+        """Return an asyncio future on the given (or current) event loop that resolves with the result"""
+        loop = loop or asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+
+        def resolve(deferred):
+            if not future.cancelled():
+                future.set_result(deferred.result)
+
+        self.add_done_callback(lambda deferred: loop.call_soon_threadsafe(resolve, deferred))
+        return future
+
+    def __await__(self):
+        return self.future().__await__()
 
 
 def task(func=None, pool=None, max_retries=0, priority=default_priority):
@@ -148,11 +951,34 @@ def task(func=None, pool=None, max_retries=0, priority=default_priority):
     if pool is None:
         pool = default_pool
 
+    coroutine = asyncio is not None and asyncio.iscoroutinefunction(func)
+
     def delay(*args, **kwargs):
         uuid = str(uuid4()) # one for each task
-        pool.queue.put((priority,dumps((func, uuid, max_retries, args, kwargs))))
-        return Deferred(pool, uuid)
+        deferred = Deferred(pool, uuid)
+        if coroutine:
+            pool.schedule(func, uuid, max_retries, args, kwargs)
+        else:
+            pool.submit(priority, func, uuid, max_retries, args, kwargs)
+        return deferred
+    def map(iterable, chunksize = 64):
+        """Run func over iterable in chunks, returning one Deferred for the list of results"""
+        uuid = str(uuid4())
+        deferred = Deferred(pool, uuid)
+        Batch(pool, func, uuid, iterable, chunksize, max_retries, priority)
+        return deferred
+
+    def imap_unordered(iterable, chunksize = 64):
+        """Run func over iterable in chunks, yielding results as each chunk completes"""
+        channel = Channel()
+        Batch(pool, func, None, iterable, chunksize, max_retries, priority, channel)
+        for results in channel:
+            for result in results:
+                yield result
+
     func.delay = delay
+    func.map = map
+    func.imap_unordered = imap_unordered
     func.pool = pool
     return func
 
@@ -160,37 +986,384 @@ def task(func=None, pool=None, max_retries=0, priority=default_priority):
 def go(*args, **kwargs):
     """Queue up a function, Go-style"""
     uuid = str(uuid4()) # one for each task
-    default_pool.queue.put((default_priority,dumps((args[0], uuid, 0, args[1:], kwargs))))
-    return Deferred(default_pool, uuid)
+    deferred = Deferred(default_pool, uuid)
+    default_pool.submit(default_priority, args[0], uuid, 0, args[1:], kwargs)
+    return deferred
+
+
+def as_completed(deferreds, timeout=None):
+    """Yield Deferreds as their tasks finish"""
+
+    deferreds = list(deferreds)
+    finished = Queue()
+    for d in deferreds:
+        d.add_done_callback(finished.put)
+    deadline = None if timeout is None else time.time() + timeout
+    for i in xrange(len(deferreds)):
+        try:
+            if deadline is None:
+                # an untimed get blocks on a lock, where any timeout makes Python 2 poll
+                yield finished.get()
+            else:
+                yield finished.get(True, max(0, deadline - time.time()))
+        except Empty:
+            raise RuntimeError("Timed out waiting for tasks.")
+
+
+def gather(deferreds, timeout=None):
+    """Wait for a set of Deferreds and return their results in order"""
+
+    deferreds = list(deferreds)
+    for d in as_completed(deferreds, timeout):
+        pass
+    return [d.result for d in deferreds]
+
+
+def _call_chunk(f, items, retries):
+    """Apply f to each item in a chunk, storing exceptions as results like single tasks do"""
+
+    results = []
+    for item in items:
+        for attempt in xrange(retries + 1):
+            try:
+                result = f(item)
+                break
+            except Exception as e:
+                log.error(traceback.format_exc())
+                result = e
+        results.append(result)
+    return results
+
+
+class Batch(object):
+    """Chunks of a task.map() call, spread across per-worker deques that idle runners steal from"""
+
+    def __init__(self, pool, f, uuid, iterable, chunksize, retries, priority, channel = None):
+        chunks = list(chunk(chunksize)(enumerate(iterable)))
+        runners = max(1, min(pool.max_workers, len(chunks)))
+        self.id        = str(uuid4())
+        self.pool      = pool
+        self.f         = f
+        self.uuid      = uuid
+        self.retries   = retries
+        self.channel   = channel
+        self.deques    = [deque() for i in xrange(runners)]
+        self.results   = [None] * sum(len(c) for c in chunks)
+        self.remaining = len(chunks)
+        self.mutex     = Lock()
+        for i, c in enumerate(chunks):
+            self.deques[i % runners].append(c)
+        if not chunks:
+            self._done()
+            return
+        batches[self.id] = self
+        for i in xrange(runners):
+            pool.submit(priority, _run_batch, None, 0, (self.id, i), {})
+
+    def steal(self, index):
+        """Take the next chunk from this runner's deque, or from the far end of another's"""
+        try:
+            return self.deques[index].popleft()
+        except IndexError:
+            pass
+        count = len(self.deques)
+        for i in xrange(1, count):
+            try:
+                return self.deques[(index + i) % count].pop()
+            except IndexError:
+                continue
+
+    def run(self, items):
+        indexes, args = zip(*items)
+        try:
+            if self.pool.processes:
+                results = self.pool.processes.apply(_call_chunk, (self.f, args, self.retries))
+            else:
+                results = _call_chunk(self.f, args, self.retries)
+        except Exception as e:
+            # e.g., an unpicklable function: fail these items but still count the chunk as done
+            log.error(traceback.format_exc())
+            results = [e] * len(args)
+        with self.mutex:
+            for i, result in zip(indexes, results):
+                self.results[i] = result
+            self.remaining -= 1
+            done = not self.remaining
+        if self.channel:
+            self.channel.send(results)
+        if done:
+            batches.pop(self.id, None)
+            self._done()
+
+    def _done(self):
+        if self.channel:
+            self.channel.close()
+        else:
+            self.pool._finish(self.uuid, self.results)
+
+
+def _run_batch(batch_id, index):
+    """Queue entry for one runner of a batch"""
+
+    batch = batches.get(batch_id)
+    if batch is None:
+        # e.g., replayed from a durable queue after a restart
+        return
+    while True:
+        items = batch.steal(index)
+        if items is None:
+            return
+        batch.run(items)
+
+
+class _ChannelState(object):
+    """Buffer shared by all the shims for a given channel"""
+
+    def __init__(self, size, uuid = None):
+        self.uuid     = uuid
+        self.size     = size
+        self.items    = deque()
+        self.closed   = False
+        self.mutex    = Lock()
+        self.readable = Condition(self.mutex)
+        self.writable = Condition(self.mutex)
+        self.watchers = set() # events set by select()
+        self.readers  = 0 # receivers blocked on an empty buffer
+        self.writers  = 0 # senders blocked on a full buffer
+
+    def put(self, item):
+        with self.mutex:
+            if self.size and len(self.items) >= self.size and not self.closed:
+                self.writers += 1
+                try:
+                    while len(self.items) >= self.size and not self.closed:
+                        self.writable.wait()
+                finally:
+                    self.writers -= 1
+            if self.closed:
+                raise RuntimeError("Channel is closed.")
+            self.items.append(item)
+            if self.readers:
+                self.readable.notify()
+            for event in self.watchers:
+                event.set()
+
+    def take(self, count, block = True, timeout = None):
+        """Remove up to count items, raising Empty if none arrived in time or RuntimeError if closed"""
+        with self.mutex:
+            if block and not self.items and not self.closed:
+                self.readers += 1
+                try:
+                    if timeout is None:
+                        while not self.items and not self.closed:
+                            self.readable.wait()
+                    else:
+                        deadline = time.time() + timeout
+                        while not self.items and not self.closed:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                break
+                            self.readable.wait(remaining)
+                finally:
+                    self.readers -= 1
+            if not self.items:
+                if self.closed:
+                    self._retire()
+                    raise RuntimeError("Channel is closed.")
+                raise Empty
+            batch = [self.items.popleft() for i in xrange(min(count, len(self.items)))]
+            if self.writers:
+                self.writable.notify(len(batch))
+            self._retire()
+            return batch
+
+    def _retire(self):
+        # queued task payloads only hold the uuid, so the registry keeps a channel alive until
+        # nothing more can come out of it, and then only as long as some shim refers to it
+        if self.closed and not self.items and self.uuid in channels:
+            closed_channels[self.uuid] = channels.pop(self.uuid)
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.readable.notify_all()
+            self.writable.notify_all()
+            for event in self.watchers:
+                event.set()
+            self._retire()
 
 
-class Channel:
-    """A serializable shim that proxies to a Queue object"""
-    def __init__(self, size):
+class Channel(object):
+    """A serializable shim that proxies to a shared buffer, which is freed once closed, drained and no shims refer to it"""
+    def __init__(self, size = 0):
         self.uuid = str(uuid4()) # one for each task
-        channels[self.uuid] = Queue(size)
+        self.state = _ChannelState(size, self.uuid)
+        channels[self.uuid] = self.state
 
-    def recv(self):
-        return channels[self.uuid].get()
+    def __getstate__(self):
+        return self.uuid
+
+    def __setstate__(self, uuid):
+        self.uuid = uuid
+        state = channels.get(uuid) or closed_channels.get(uuid)
+        if state is None:
+            # closed and drained before this shim was unpickled, so there is nothing left to receive
+            state = _ChannelState(0, uuid)
+            state.closed = True
+        self.state = state
+
+    def recv(self, block = True, timeout = None):
+        """Receive an item, raising RuntimeError once the channel is closed and drained"""
+        return self.state.take(1, block, timeout)[0]
+
+    def recv_many(self, count, block = True, timeout = None):
+        """Receive up to count items at once, or an empty list once the channel is closed and drained"""
+        try:
+            return self.state.take(count, block, timeout)
+        except RuntimeError:
+            return []
 
     def send(self, item):
-        if self.uuid in closed:
-            raise RuntimeError("Channel is closed.")
-        channels[self.uuid].put(item)
+        self.state.put(item)
 
     def close(self):
-        closed[self.uuid] = True
+        """Close the channel, waking up any blocked receivers"""
+        self.state.close()
 
     def __iter__(self):
-        yield self.recv()
         while True:
             try:
-                res = channels[self.uuid].get(True, 1.0/default_pool.rate_limit)
-                yield res
-            except Empty:
-                # check channel again and end iteration if closed
-                if channels[self.uuid].empty() and (self.uuid in closed):
-                    return
+                batch = self.state.take(64)
+            except RuntimeError:
+                return
+            for item in batch:
+                yield item
+
+
+def select(chans, timeout = None):
+    """Receive from whichever channel has an item first, returning (channel, item)"""
+
+    event = Event()
+    for c in chans:
+        with c.state.mutex:
+            c.state.watchers.add(event)
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        while True:
+            # clear before checking, so that sends from here on aren't missed
+            event.clear()
+            pending = False
+            for c in chans:
+                try:
+                    return c, c.state.take(1, False)[0]
+                except Empty:
+                    pending = True
+                except RuntimeError:
+                    pass
+            if not pending:
+                raise RuntimeError("All channels are closed.")
+            if deadline is None:
+                event.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Empty
+                event.wait(remaining)
+    finally:
+        for c in chans:
+            with c.state.mutex:
+                c.state.watchers.discard(event)
+
+
+class AsyncChannel(object):
+    """A channel received from inside an event loop, fed from any thread (or from the loop with send_async)"""
+
+    def __init__(self, size = 0, loop = None):
+        self.loop    = loop or asyncio.get_event_loop()
+        self.items   = deque()
+        self.waiters = deque()
+        self.senders = deque() # (future, item) for send_async() calls waiting for room
+        self.slots   = Semaphore(size) if size else None
+        self.closed  = False
+
+    def _on_loop(self):
+        try:
+            return self.loop.is_running() and asyncio.get_event_loop() is self.loop
+        except RuntimeError:
+            # no event loop for this thread
+            return False
+
+    def _release(self):
+        while self.senders:
+            future, item = self.senders.popleft()
+            if not future.cancelled():
+                # hand the freed slot straight to a sender waiting on the loop
+                future.set_result(None)
+                self._deliver(item)
+                return
+        if self.slots:
+            self.slots.release()
+
+    def _deliver(self, item):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.cancelled():
+                self._release()
+                waiter.set_result(item)
+                return
+        self.items.append(item)
+
+    def _wake(self):
+        for pending in (self.waiters, [future for future, item in self.senders]):
+            for future in pending:
+                if not future.cancelled():
+                    future.set_exception(RuntimeError("Channel is closed."))
+        self.waiters.clear()
+        self.senders.clear()
+
+    def send(self, item):
+        """Queue an item, blocking the calling thread while the channel is full
+
+        Blocking the event loop's own thread would deadlock, since only recv() on the loop makes room,
+        so there a full channel raises RuntimeError instead (use send_async)."""
+        if self.closed:
+            raise RuntimeError("Channel is closed.")
+        if self.slots:
+            if self._on_loop():
+                if not self.slots.acquire(False):
+                    raise RuntimeError("Channel is full, use send_async() from the event loop.")
+            else:
+                self.slots.acquire()
+        self.loop.call_soon_threadsafe(self._deliver, item)
+
+    def send_async(self, item):
+        """Return a future that resolves once the item is queued (must be called from the event loop)"""
+        future = asyncio.Future(loop=self.loop)
+        if self.closed:
+            future.set_exception(RuntimeError("Channel is closed."))
+        elif not self.slots or self.slots.acquire(False):
+            self._deliver(item)
+            future.set_result(None)
+        else:
+            self.senders.append((future, item))
+        return future
+
+    def recv(self):
+        """Return a future for the next item (must be called from the event loop)"""
+        future = asyncio.Future(loop=self.loop)
+        if self.items:
+            self._release()
+            future.set_result(self.items.popleft())
+        elif self.closed:
+            future.set_exception(RuntimeError("Channel is closed."))
+        else:
+            self.waiters.append(future)
+        return future
+
+    def close(self):
+        """Close the channel, failing pending receivers once queued items are drained"""
+        self.closed = True
+        self.loop.call_soon_threadsafe(self._wake)
 
 
 def chan(size = 0):
@@ -208,3 +1381,71 @@ def start(daemonize = False):
     signal(SIGINT, halt)
     signal(SIGTERM, halt)
     default_pool.start(daemonize = daemonize)
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    starts = []
+
+    def noop():
+        starts.append(time.time())
+
+    # Dispatch benchmark: spawn-per-task loop versus persistent workers
+    for label, pool in [('spawn', Pool()), ('persistent', Pool(persistent=True, rate_limit=None))]:
+        del starts[:]
+        noop = task(noop, pool=pool)
+        for i in xrange(count):
+            noop.delay()
+        begin = time.time()
+        pool.start()
+        elapsed = time.time() - begin
+        starts.sort()
+        gaps = sorted(b - a for a, b in zip(starts, starts[1:])) or [0]
+        print "%-10s %10.0f tasks/s  p99 dispatch %.3fms" % (label, len(starts) / elapsed, gaps[int(len(gaps) * 0.99)] * 1000)
+
+    # Channel benchmark: a polling Queue (the previous implementation) versus Channel
+    def polling(queue, done):
+        while True:
+            try:
+                yield queue.get(True, 1.0/default_rate_limit)
+            except Empty:
+                if queue.empty() and done:
+                    return
+
+    def produce(send, close):
+        for i in xrange(count):
+            send(i)
+        close()
+
+    for label in ['queue', 'channel']:
+        if label == 'queue':
+            queue, done = Queue(1024), []
+            producer = Thread(target=produce, args=[queue.put, lambda: done.append(True)])
+            consumer = polling(queue, done)
+        else:
+            c = chan(1024)
+            producer = Thread(target=produce, args=[c.send, c.close])
+            consumer = iter(c)
+        begin = time.time()
+        producer.start()
+        received = sum(1 for item in consumer)
+        elapsed = time.time() - begin
+        print "%-10s %10.0f messages/s" % (label, received / elapsed)
+
+    # Durable queue benchmark: journaled enqueues
+    import tempfile
+    fd, path = tempfile.mkstemp('.log')
+    os.close(fd)
+    for label, synchronous in [('durable', False), ('durable+sync', True)]:
+        os.remove(path)
+        queue = DurableQueue(path, synchronous=synchronous)
+        payload = dumps((noop, str(uuid4()), 0, (), {}))
+        begin = time.time()
+        for i in xrange(count):
+            queue.put((default_priority, payload + str(i)))
+        queue.sync()
+        elapsed = time.time() - begin
+        queue.close()
+        print "%-12s %8.0f enqueues/s" % (label, count / elapsed)
+    os.remove(path)
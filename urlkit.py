@@ -14,7 +14,7 @@ import sys
 log = logging.getLogger()
 
 import re
-import gzip
+import zlib
 import base64
 import tempfile
 import urllib
@@ -24,16 +24,23 @@ from StringIO import StringIO
 from xml.dom.minidom import parseString
 from urllib2 import HTTPCookieProcessor, HTTPRedirectHandler, HTTPDefaultErrorHandler, HTTPError
 import cookielib
+import httplib
+import socket
+import errno
+import threading
+import collections
+import Queue
+import time
 from collections import defaultdict
 from utils.core import tb
 from config import settings
-from utils.decorators import memoize
+from utils.decorators import memoize, MemoryBackend, SQLiteBackend, TieredBackend
 from datetime import datetime
 
 # Initialize debug level upon module load
 #httplib.HTTPConnection.debuglevel = settings.httplib.debuglevel
 
-@memoize
+@memoize(max_size=1024)
 def shorten(url):
     """Minimalist URL shortener using SAPO services"""
     u = '?'.join(('http://services.sapo.pt/PunyURL/GetCompressedURLByURL', urllib.urlencode({'url':url})))
@@ -44,7 +51,7 @@ def shorten(url):
         return url
         
 
-@memoize
+@memoize(max_size=1024)
 def agnostic_shortener(url):
     """A more flexible URL shortener"""
     
@@ -69,7 +76,105 @@ def agnostic_shortener(url):
     return url
 
 
-def expand(url, remove_junk = True, timeout = None):
+# how long expand() remembers where a URL leads, unless Cache-Control says otherwise
+resolution_ttl = 3600
+permanent_ttl = 86400 # for 301 and 308 redirects
+negative_ttl = 300 # for URLs that couldn't be resolved
+
+resolutions = MemoryBackend(10000)
+
+
+def persist_resolutions(path, max_size=None):
+    """Keep resolved URLs in an SQLite file as well, so that they survive restarts"""
+
+    global resolutions
+    resolutions = TieredBackend([MemoryBackend(10000), SQLiteBackend(path, max_size)])
+
+
+def _freshness(headers, status):
+    """Return how long a response may be reused for, in seconds"""
+
+    directives = {}
+    for directive in headers.get('cache-control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        try:
+            return int(directives[name])
+        except (KeyError, ValueError):
+            pass
+    return permanent_ttl if status in (301, 308) else resolution_ttl
+
+
+def _resolve(url, timeout, user_agent, session = None):
+    """Follow redirects one hop at a time, returning the final URL (None on failure) and caching it for every hop"""
+
+    session = session or default_session
+    now = time.time()
+    chain = [] # (hop, expires)
+    target, expires = None, float('inf')
+    current = url
+    for _ in xrange(session.max_redirects + 1):
+        try:
+            # chains that share hops pick up where a previous resolution left off
+            target, expires = resolutions.get(current)
+            if expires > now:
+                break
+        except KeyError:
+            pass
+        target, expires = None, float('inf')
+        try:
+            f = session.open(current, headers={'User-Agent': user_agent}, method='HEAD', timeout=timeout, follow=False)
+            f.close()
+        except Exception:
+            #log.debug(u"%s: %s" % (tb(),current))
+            chain.append((current, now + negative_ttl))
+            break
+        ttl = _freshness(f.headers, f.code)
+        if f.code >= 500 or f.code == 429:
+            # transient failures shouldn't pin a short URL for as long as a real answer would
+            ttl = min(ttl, negative_ttl)
+        chain.append((current, now + ttl))
+        location = f.headers.get('location')
+        if f.code not in Session.redirect_codes or not location:
+            target = current
+            break
+        current = urlparse.urljoin(current, location)
+        if urlparse.urlparse(current)[0] not in ['http', 'https']:
+            target = current
+            break
+    else:
+        expires = now + negative_ttl
+    # a hop leads to the same place as the rest of the chain, for no longer than any hop after it
+    for hop, hop_expires in reversed(chain):
+        expires = min(expires, hop_expires)
+        if expires > now:
+            resolutions.set(hop, (target, expires), expires - now)
+    return target
+
+
+_expander = (None, None, None, None)
+
+
+def _expander_settings():
+    """Return the ignore list matcher, user agent table and default user agent, rebuilding them only when settings change"""
+
+    global _expander
+    ignore, user_agents, default = settings.expander.ignore, settings.expander.user_agents, settings.fetcher.user_agent
+    key = (tuple(ignore), tuple(user_agents.items()), default)
+    if key != _expander[0]:
+        if ignore:
+            # a single alternation is matched in one pass, instead of recompiling it on every call
+            match = re.compile("(" + ")|(".join([i.replace('.','\.').replace('*','.+') for i in ignore]) + ")").match
+        else:
+            match = lambda netloc: None
+        _expander = (key, match, dict(user_agents), default)
+    return _expander[1:]
+
+
+def expand(url, remove_junk = True, timeout = None, session = None):
     """Resolve short URLs"""
     url = unicode(url)
     result = url
@@ -81,27 +186,22 @@ def expand(url, remove_junk = True, timeout = None):
     if scheme not in ['http','https']:
         return result
     
+    ignored, user_agents, default_user_agent = _expander_settings()
+
     # time sinks that aren't worth expanding further
-    if re.match( "(" + ")|(".join([i.replace('.','\.').replace('*','.+') for i in settings.expander.ignore]) + ")", netloc):
+    if ignored(netloc):
         return result
         
-    res = {}    
-    user_agents = defaultdict(lambda: settings.fetcher.user_agent)
-    user_agents.update(settings.expander.user_agents)
-    user_agent = user_agents[netloc]
+    user_agent = user_agents.get(netloc, default_user_agent)
     
-    try:
-        res = fetch(url, head=True, timeout=timeout, user_agent=user_agent)
-    except: 
-        #log.debug(u"%s: %s" % (tb(),url))
-        pass
+    target = _resolve(url, timeout, user_agent, session)
     
-    if 'url' in res:
-        (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(res['url'])
+    if target:
+        (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(target)
         if scheme not in ['http','https']:
             return result
         else: 
-            result = res['url']
+            result = unicode(target)
     
     if remove_junk:
         result = scrub_query(result)
@@ -161,7 +261,210 @@ class DefaultErrorHandler(HTTPDefaultErrorHandler):
         return result
 
 
-def _open_source(source, head, data = None, etag = None, last_modified = None, timeout = None, user_agent = "Mozilla/5.0"):
+class _CookieResponse(object):
+    """Adapter exposing response headers the way cookielib expects"""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+
+class Response(object):
+    """File-like HTTP response that hands its connection back to the pool once fully read"""
+
+    def __init__(self, session, key, conn, resp, url, status):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.status = status
+        self.code = resp.status
+        self.headers = resp.msg
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        data = self.resp.read(amt)
+        if self.resp.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self.conn:
+            if self.resp.will_close:
+                self.conn.close()
+            else:
+                self.session._release(self.key, self.conn)
+            self.conn = None
+
+    def close(self):
+        if self.resp.length == 0:
+            # nothing to read (e.g., HEAD), but httplib only finishes the response on a read
+            self.read()
+        if self.conn:
+            # a partially read body leaves the connection in an unknown state
+            if not self.resp.isclosed():
+                self.conn.close()
+                self.conn = None
+            self._release()
+        self.resp.close()
+
+
+class Session(object):
+    """Keep-alive HTTP client with per-host connection pools and a persistent cookie jar"""
+
+    redirect_codes = (301, 302, 303, 307, 308)
+    # methods that can safely be sent again when a pooled connection turns out to be stale
+    idempotent = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+    def __init__(self, pool_size=4, max_redirects=10, cookie_file=None, proxies=None):
+        self.pool_size = pool_size
+        self.max_redirects = max_redirects
+        # scheme -> proxy URL, from http_proxy/https_proxy (and honouring no_proxy) unless given
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self.bypass = urllib.proxy_bypass if proxies is None else lambda host: False
+        self.pools = defaultdict(list) # (scheme, host, port, proxy) -> idle connections
+        self.lock = threading.Lock()
+        self.jar = cookielib.MozillaCookieJar(cookie_file)
+        self.jar.set_policy(cookielib.DefaultCookiePolicy(rfc2965=True, strict_rfc2965_unverifiable=False))
+        if cookie_file and os.path.exists(cookie_file):
+            try:
+                self.jar.load(ignore_discard=True)
+            except (IOError, cookielib.LoadError):
+                log.warn("Could not load cookies from %s" % cookie_file)
+
+    def _acquire(self, key, timeout):
+        """Return an idle connection for key, or a new one, and whether it was reused"""
+
+        with self.lock:
+            pool = self.pools.get(key)
+            conn = pool.pop() if pool else None
+        if conn:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, host, port, proxy = key
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        if not proxy:
+            return cls(host, port, timeout=timeout), False
+        proxy_host, proxy_port, auth = proxy
+        conn = cls(proxy_host, proxy_port, timeout=timeout)
+        if scheme == 'https':
+            conn.set_tunnel(host, port, {'Proxy-Authorization': auth} if auth else None)
+        return conn, False
+
+    def _proxy(self, scheme, host):
+        """Return (host, port, Proxy-Authorization) for the proxy to use, if any"""
+
+        proxy = self.proxies.get(scheme)
+        if not proxy or self.bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        auth = None
+        if parts.username:
+            auth = 'Basic ' + base64.b64encode('%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or '')))
+        return parts.hostname, parts.port or 8080, auth
+
+    def _stale(self, method, error):
+        """Tell whether a failed request was most likely on a connection the server had already dropped"""
+
+        if method not in self.idempotent or isinstance(error, socket.timeout):
+            # the request may have been handled, and retrying would double the wait
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+    def _release(self, key, conn):
+        with self.lock:
+            pool = self.pools[key]
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _send(self, method, url, data, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        proxy = self._proxy(parts.scheme, parts.hostname)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80), proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        cookie_request = urllib2.Request(url)
+        self.jar.add_cookie_header(cookie_request)
+        headers = dict(headers, **cookie_request.unredirected_hdrs)
+        if proxy and parts.scheme == 'http':
+            # plain HTTP goes to the proxy with the full URL, HTTPS is tunnelled instead
+            path = urlparse.urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+            if proxy[2]:
+                headers['Proxy-Authorization'] = proxy[2]
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                conn.request(method, path, data, headers)
+                resp = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                # the server may have dropped an idle connection, so retry those on a fresh one
+                if not reused or not self._stale(method, e):
+                    raise
+        self.jar.extract_cookies(_CookieResponse(resp.msg), cookie_request)
+        return key, conn, resp
+
+    def open(self, url, data=None, headers=None, method=None, timeout=None, follow=True):
+        """Issue a request, following redirects unless told otherwise, and return a file-like Response"""
+
+        method = method or ('POST' if data else 'GET')
+        headers = dict(headers or {})
+        status = None
+        for _ in xrange(self.max_redirects + 1):
+            key, conn, resp = self._send(method, url, data, headers, timeout)
+            location = resp.getheader('location')
+            if not follow or resp.status not in self.redirect_codes or not location:
+                return Response(self, key, conn, resp, url, status or resp.status)
+            # like urllib2, report the status of the first redirect
+            status = status or resp.status
+            self._discard(key, conn, resp)
+            url = urlparse.urljoin(url, location)
+            if method not in ('GET', 'HEAD') and resp.status not in (307, 308):
+                method, data = 'GET', None
+        raise HTTPError(url, resp.status, "Too many redirects", resp.msg, None)
+
+    def _discard(self, key, conn, resp):
+        # small redirect bodies are cheaper to drain than a new connection
+        response = Response(self, key, conn, resp, None, None)
+        if resp.length is not None and resp.length < 65536:
+            response.read()
+        response.close()
+
+    def save(self):
+        if self.jar.filename:
+            with self.lock:
+                self.jar.save(ignore_discard=True)
+
+    def close(self):
+        """Close idle connections, and save cookies if there is a cookie file"""
+
+        with self.lock:
+            pools, self.pools = self.pools, defaultdict(list)
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+        self.save()
+
+
+default_session = Session()
+
+
+def _open_source(source, head, data = None, etag = None, last_modified = None, timeout = None, user_agent = "Mozilla/5.0", session = None):
     """Open anything"""
 
     if hasattr(source, 'read'):
@@ -170,19 +473,15 @@ def _open_source(source, head, data = None, etag = None, last_modified = None, t
         return sys.stdin
 
     if urlparse.urlparse(source)[0][:4] == 'http':
-        request = urllib2.Request(source, data)
-        if head and not data:
-            request.get_method = lambda: 'HEAD'
-        request.add_header('User-Agent', user_agent)
+        headers = {'User-Agent': user_agent, 'Accept-Encoding': 'gzip'}
         if etag:
-            request.add_header('If-None-Match', etag)
+            headers['If-None-Match'] = etag
         if last_modified:
-            request.add_header('If-Modified-Since', last_modified)
-        request.add_header('Accept-encoding', 'gzip')
-        jar = cookielib.MozillaCookieJar()                         
-        jar.set_policy(cookielib.DefaultCookiePolicy(rfc2965=True, strict_rfc2965_unverifiable=False))
-        opener = urllib2.build_opener(SmartRedirectHandler(), HTTPCookieProcessor(jar), DefaultErrorHandler())
-        return opener.open(request, None, timeout)
+            headers['If-Modified-Since'] = last_modified
+        if data:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        method = 'HEAD' if head and not data else None
+        return (session or default_session).open(source, data, headers, method, timeout)
     try:
         return open(source)
     except(IOError,OSError):
@@ -190,17 +489,96 @@ def _open_source(source, head, data = None, etag = None, last_modified = None, t
     return StringIO(str(source))
 
 
-def fetch(url, data = None, etag = None, last_modified = None, head = False, timeout = None, user_agent = "Mozilla/5.0"):
-    """Fetch a URL and return the contents"""
+def _decode(f, encoding, max_bytes=None, chunk_size=16384):
+    """Read a response in chunks, yielding them decompressed as they arrive and stopping after max_bytes"""
+
+    if encoding in ('gzip', 'x-gzip'):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decoder = zlib.decompressobj()
+    else:
+        decoder = None
+    remaining = max_bytes
+    started = False
+    while remaining is None or remaining > 0:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        if not decoder:
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+            yield data
+            continue
+        # decompress at most chunk_size at a time, so highly compressed bodies don't balloon in memory
+        while data and (remaining is None or remaining > 0):
+            limit = chunk_size if remaining is None else min(chunk_size, remaining)
+            try:
+                out = decoder.decompress(data, limit)
+            except zlib.error:
+                if encoding != 'deflate' or started:
+                    raise
+                # some servers send raw deflate streams without the zlib header
+                decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                out = decoder.decompress(data, limit)
+            started = True
+            data = decoder.unconsumed_tail
+            if remaining is not None:
+                remaining -= len(out)
+            if out:
+                yield out
+    if decoder and (remaining is None or remaining > 0):
+        data = decoder.flush()
+        if data:
+            yield data[:remaining] if remaining is not None else data
+
+
+def _until(chunks, marker):
+    """Pass chunks through up to and including the first occurrence of marker (ignoring case)"""
+
+    marker = marker.lower()
+    tail = ''
+    for chunk in chunks:
+        window = (tail + chunk).lower()
+        i = window.find(marker)
+        if i >= 0:
+            yield chunk[:i + len(marker) - len(tail)]
+            return
+        yield chunk
+        tail = (tail + chunk)[-(len(marker) - 1):] if len(marker) > 1 else ''
+
+
+def fetch_stream(url, max_bytes=None, until=None, chunk_size=16384, etag = None, last_modified = None, timeout = None, user_agent = "Mozilla/5.0", session = None):
+    """Fetch a URL, yielding decoded chunks of its body as they arrive
+
+    Stops after max_bytes of decoded data, or once until (e.g., '</head>') has been read, and
+    the connection is dropped as soon as the caller stops iterating."""
+
+    f = _open_source(url, False, None, etag, last_modified, timeout, user_agent, session)
+    try:
+        encoding = f.headers.get('content-encoding', '').lower() if hasattr(f, 'headers') else None
+        chunks = _decode(f, encoding, max_bytes, chunk_size)
+        if until:
+            chunks = _until(chunks, until)
+        for chunk in chunks:
+            yield chunk
+    finally:
+        f.close()
+
+
+def fetch(url, data = None, etag = None, last_modified = None, head = False, timeout = None, user_agent = "Mozilla/5.0", session = None, max_bytes = None, until = None):
+    """Fetch a URL and return the contents, optionally only up to max_bytes or until a marker"""
 
     result = {}
-    f = _open_source(url, head, data, etag, last_modified, timeout, user_agent)
-    if not head:
-        result['data'] = f.read()
+    f = _open_source(url, head, data, etag, last_modified, timeout, user_agent, session)
     if hasattr(f, 'headers'):
         result.update({k.lower(): f.headers.get(k) for k in f.headers})
-        if f.headers.get('content-encoding', '') == 'gzip' and not head:
-            result['data'] = gzip.GzipFile(fileobj=StringIO(result['data'])).read()
+    if not head:
+        # decoding as we read avoids holding both the compressed and decompressed body
+        chunks = _decode(f, result.get('content-encoding', '').lower(), max_bytes)
+        if until:
+            chunks = _until(chunks, until)
+        result['data'] = ''.join(chunks)
     if hasattr(f.headers, 'last-modified'):
         try:
             result['modified_parsed'] = datetime.strptime(f.headers['last-modified'], "%a, %d %b %Y %H:%M:%S %Z")
@@ -216,20 +594,204 @@ def fetch(url, data = None, etag = None, last_modified = None, head = False, tim
     return result
 
 
-def download(url, filename=None, suffix='', user_agent = "Mozilla/5.0"):
-    """Convenience function for downloading a URL directly to the filesystem"""
+def _host(url):
+    try:
+        return urlparse.urlsplit(url).hostname
+    except Exception:
+        return None
+
+
+def _run_many(func, urls, workers, per_host):
+    """Apply func to urls in worker threads, at most per_host at a time for any host, yielding
+    (url, result) pairs in completion order. Exceptions are returned as results."""
+
+    pending = defaultdict(collections.deque)
+    for url in urls:
+        pending[_host(url)].append(url)
+    hosts = collections.deque(pending) # round robin, so one busy host doesn't hold up the rest
+    active = defaultdict(int)
+    total = sum(len(q) for q in pending.itervalues())
+    cond = threading.Condition()
+    results = Queue.Queue()
+    state = {'stopped': False}
+
+    def take():
+        with cond:
+            while not state['stopped'] and hosts:
+                for _ in xrange(len(hosts)):
+                    host = hosts[0]
+                    hosts.rotate(-1)
+                    if active[host] < per_host:
+                        url = pending[host].popleft()
+                        if not pending[host]:
+                            hosts.remove(host)
+                        active[host] += 1
+                        return host, url
+                cond.wait()
+            return None, None
+
+    def worker():
+        while True:
+            host, url = take()
+            if url is None:
+                return
+            try:
+                result = func(url)
+            except Exception as e:
+                result = e
+            with cond:
+                active[host] -= 1
+                cond.notify_all()
+            results.put((url, result))
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(workers, total))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for _ in xrange(total):
+            # an untimed get blocks on a lock, where any timeout makes Python 2 poll
+            yield results.get()
+    finally:
+        # stop handing out work if the caller bails out early
+        with cond:
+            state['stopped'] = True
+            cond.notify_all()
+
+
+def fetch_many(urls, workers=16, per_host=4, **kwargs):
+    """Fetch URLs concurrently, yielding (url, result) as each completes, with errors as exceptions.
+    Takes the same keyword arguments as fetch (e.g., timeout for each request)."""
+
+    return _run_many(lambda url: fetch(url, **kwargs), urls, workers, per_host)
+
+
+def expand_many(urls, workers=16, per_host=4, **kwargs):
+    """Expand URLs concurrently, yielding (url, expanded) as each completes"""
 
-    opener = urllib.FancyURLopener({}) 
-    opener.version = user_agent
+    return _run_many(lambda url: expand(url, **kwargs), urls, workers, per_host)
+
+
+def download(url, filename=None, suffix='', user_agent = "Mozilla/5.0", session = None):
+    """Convenience function for downloading a URL directly to the filesystem"""
 
     if not filename:
         fd, filename = tempfile.mkstemp(suffix)
         os.close(fd)
 
     try:
-        opener.retrieve(url, filename)
+        if urlparse.urlparse(url)[0] not in ['http', 'https']:
+            opener = urllib.FancyURLopener({})
+            opener.version = user_agent
+            opener.retrieve(url, filename)
+            return filename
+        f = (session or default_session).open(url, headers={'User-Agent': user_agent})
+        try:
+            # status is that of the first redirect, code is the final one
+            if f.code >= 400:
+                raise HTTPError(url, f.code, f.resp.reason, f.headers, None)
+            with open(filename, 'wb') as out:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+        finally:
+            f.close()
         return filename
     except Exception as e:
         log.error("Could not download %(url)s: %(e)s" % locals())
         return None
 
+
+
+if __name__ == '__main__':
+
+    import time
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Local stand-in for a crawled site, with keep-alive and a redirect"""
+
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes, which Nagle would hold back on a warm connection
+        disable_nagle_algorithm = True
+        body = 'x' * 2048
+
+        def do_GET(self):
+            if self.path == '/short':
+                self.send_response(301)
+                self.send_header('Location', '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever).start()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def opener_per_request(url):
+        """The previous behaviour: a fresh jar, opener and connection every time"""
+
+        jar = cookielib.MozillaCookieJar()
+        opener = urllib2.build_opener(SmartRedirectHandler(), HTTPCookieProcessor(jar), DefaultErrorHandler())
+        f = opener.open(urllib2.Request(url))
+        f.read()
+        f.close()
+
+    # expand() overhead, with the network stubbed out
+    def old_prelude(url):
+        """The previous per-call setup: recompile the ignore list, rebuild the user agent table"""
+
+        netloc = urlparse.urlparse(url)[1]
+        if re.match( "(" + ")|(".join([i.replace('.','\.').replace('*','.+') for i in settings.expander.ignore]) + ")", netloc):
+            return url
+        user_agents = defaultdict(lambda: settings.fetcher.user_agent)
+        user_agents.update(settings.expander.user_agents)
+        return user_agents[netloc]
+
+    def new_prelude(url):
+        netloc = urlparse.urlparse(url)[1]
+        ignored, user_agents, default_user_agent = _expander_settings()
+        if ignored(netloc):
+            return url
+        return user_agents.get(netloc, default_user_agent)
+
+    resolve, _resolve = _resolve, lambda url, timeout, user_agent: url
+    n = 20000
+    def old_prelude_cold(url):
+        """The old setup once re's 100 pattern cache has been flushed by other regexes"""
+
+        re.purge()
+        return old_prelude(url)
+
+    for name, f in [('old setup', old_prelude), ('old, cold re', old_prelude_cold), ('new setup', new_prelude), ('expand', expand)]:
+        start = time.time()
+        for i in xrange(n):
+            f('http://t.co/%d' % i)
+        print "%-14s %6.1fus/call" % (name, (time.time() - start) / n * 1e6)
+    _resolve = resolve
+
+    n = 500
+    for path in ['/', '/short']:
+        for name, f in [('opener per request', opener_per_request), ('session', lambda u: fetch(u))]:
+            start = time.time()
+            for _ in xrange(n):
+                f(base + path)
+            elapsed = time.time() - start
+            print "%-8s %-20s %7.0f requests/s" % (path, name, n / elapsed)
+    server.shutdown()